@@ -1,20 +1,98 @@
-from fastapi import FastAPI, HTTPException, Depends
-from sqlalchemy import Column, Integer, String, ForeignKey, create_engine, Table
+import os
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from functools import wraps
+from itertools import count
+
+from cachetools import TTLCache
+from fastapi import FastAPI, HTTPException, Depends, Query, Request
+from fastapi.encoders import jsonable_encoder
+from pydantic import BaseModel, ConfigDict
+from sqlalchemy import (
+    Column,
+    Integer,
+    String,
+    ForeignKey,
+    Table,
+    Index,
+    event,
+    select,
+    insert,
+    update,
+    delete,
+    text,
+    Float,
+    bindparam,
+    lambda_stmt,
+    func,
+    desc,
+)
+from sqlalchemy.ext.asyncio import (
+    AsyncSession,
+    create_async_engine,
+    async_sessionmaker,
+    async_scoped_session,
+)
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker, relationship, Session
+from sqlalchemy.orm import (
+    Session,
+    object_session,
+    relationship,
+    selectinload,
+    joinedload,
+    raiseload,
+)
+from sqlalchemy.pool import AsyncAdaptedQueuePool
 
 # creating slq lite database
-DATABASE_URL = "sqlite:///./students.db"
-engine = create_engine(DATABASE_URL, connect_args={"check_same_thread": False})
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+DATABASE_URL = "sqlite+aiosqlite:///./students.db"
+engine = create_async_engine(
+    DATABASE_URL,
+    connect_args={"check_same_thread": False},
+    query_cache_size=1200,
+    # a fixed set of connections reused across requests, each already has the
+    # pragmas below applied
+    poolclass=AsyncAdaptedQueuePool,
+    pool_size=20,
+    max_overflow=10,
+    pool_pre_ping=True,
+    pool_recycle=3600,
+)
+
+
+# tuning sqlite on every new connection: WAL lets readers run during writes,
+# synchronous=NORMAL drops the fsync per commit (still safe with WAL)
+@event.listens_for(engine.sync_engine, "connect")
+def set_sqlite_pragma(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute("PRAGMA temp_store=MEMORY")
+    cursor.execute("PRAGMA cache_size=-64000")
+    cursor.execute("PRAGMA mmap_size=268435456")
+    cursor.close()
+
+
+# one shared session per request: the middleware gives every request its own
+# scope id and the tasks serving that request inherit it from the context
+request_scope = ContextVar("request_scope", default=None)
+request_ids = count()
+SessionLocal = async_scoped_session(
+    async_sessionmaker(engine, autoflush=False, expire_on_commit=False),
+    scopefunc=request_scope.get,
+)
 Base = declarative_base()
 
 # creating table for student-subject relationship
 student_subject = Table(
     "student_subject",
     Base.metadata,
-    Column("student_id", Integer, ForeignKey("students.id")),
-    Column("subject_id", Integer, ForeignKey("subjects.id")),
+    Column("student_id", Integer, ForeignKey("students.id"), primary_key=True),
+    Column("subject_id", Integer, ForeignKey("subjects.id"), primary_key=True),
+    # the composite key only exists on new databases, this also guards the
+    # shipped students.db against duplicate enrollments
+    Index("ix_ss_pair", "student_id", "subject_id", unique=True),
+    Index("ix_student_subject_subject", "subject_id"),
 )
 
 
@@ -46,6 +124,10 @@ class Subject(Base):
 
 class Score(Base):
     __tablename__ = "scores"
+    __table_args__ = (
+        Index("ix_scores_student_subject", "student_id", "subject_id"),
+        Index("ix_scores_subject", "subject_id"),
+    )
     id = Column(Integer, primary_key=True, index=True)
     student_id = Column(Integer, ForeignKey("students.id"))
     subject_id = Column(Integer, ForeignKey("subjects.id"))
@@ -54,129 +136,450 @@ class Score(Base):
     subject = relationship("Subject", back_populates="scores")
 
 
-# creating tables
-Base.metadata.create_all(bind=engine)
+# request body for adding many scores at once
+class ScoreIn(BaseModel):
+    student_id: int
+    subject_id: int
+    score: int
+
+
+# response bodies, read straight from orm objects or selected rows
+class StudentOut(BaseModel):
+    model_config = ConfigDict(from_attributes=True)
+    id: int
+    name: str | None
+    surname: str | None
+
+
+class SubjectOut(BaseModel):
+    model_config = ConfigDict(from_attributes=True)
+    id: int
+    name: str | None
+
+
+class ScoreOut(BaseModel):
+    model_config = ConfigDict(from_attributes=True)
+    id: int
+    student_id: int | None
+    subject_id: int | None
+    score: int | None
+
+
+class StudentDetail(StudentOut):
+    subjects: list[SubjectOut]
+    scores: list[ScoreOut]
+
+
+class ScoreDetail(ScoreOut):
+    student: StudentOut | None
+    subject: SubjectOut | None
+
+
+class StudentAverage(BaseModel):
+    student_id: int
+    average: float | None
+    lowest: int | None
+    highest: int | None
+
+
+class SubjectAverage(BaseModel):
+    id: int
+    name: str | None
+    average: float | None
+
+
+# create_all skips tables that already exist, so indexes added later
+# to an existing database are created here
+def create_indexes(conn):
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(conn, checkfirst=True)
+
+
+# full-text index over student names, kept in sync with the students table by
+# triggers so searches don't have to LIKE-scan every row
+STUDENTS_FTS = [
+    """
+    CREATE VIRTUAL TABLE IF NOT EXISTS students_fts USING fts5(
+        name, surname,
+        content='students', content_rowid='id',
+        tokenize='unicode61 remove_diacritics 1', prefix='2 3 4'
+    )
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS students_fts_insert AFTER INSERT ON students BEGIN
+        INSERT INTO students_fts(rowid, name, surname)
+        VALUES (new.id, new.name, new.surname);
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS students_fts_delete AFTER DELETE ON students BEGIN
+        INSERT INTO students_fts(students_fts, rowid, name, surname)
+        VALUES ('delete', old.id, old.name, old.surname);
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS students_fts_update AFTER UPDATE ON students BEGIN
+        INSERT INTO students_fts(students_fts, rowid, name, surname)
+        VALUES ('delete', old.id, old.name, old.surname);
+        INSERT INTO students_fts(rowid, name, surname)
+        VALUES (new.id, new.name, new.surname);
+    END
+    """,
+]
+
+
+def create_search_index(conn):
+    exists = conn.exec_driver_sql(
+        "SELECT 1 FROM sqlite_master WHERE name = 'students_fts'"
+    ).first()
+    for statement in STUDENTS_FTS:
+        conn.exec_driver_sql(statement)
+    if not exists:
+        # indexing the students that were there before the fts table
+        conn.exec_driver_sql(
+            "INSERT INTO students_fts(students_fts) VALUES ('rebuild')"
+        )
+
+
+# creating tables on startup
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+        await conn.run_sync(create_indexes)
+        await conn.run_sync(create_search_index)
+    yield
+    await engine.dispose()
+
+
+# with SQLA_RAISELOAD=1 any relationship that wasn't eager-loaded raises
+# instead of quietly emitting one SELECT per row
+RAISELOAD = os.getenv("SQLA_RAISELOAD") == "1"
+
+
+def eager(*options):
+    if RAISELOAD:
+        return (*options, raiseload("*"))
+    return options
+
+
+# by-id lookups built once, later calls reuse the cached statement and
+# its compiled sql instead of rebuilding the select every request
+STUDENT_BY_ID = lambda_stmt(
+    lambda: select(Student)
+    .options(*eager(selectinload(Student.subjects), selectinload(Student.scores)))
+    .where(Student.id == bindparam("pk"))
+)
+SCORE_BY_ID = lambda_stmt(
+    lambda: select(Score)
+    .options(*eager(joinedload(Score.student), joinedload(Score.subject)))
+    .where(Score.id == bindparam("pk"))
+)
+
+
+# caching read endpoints per model, saved as plain json so a hit never
+# touches the database or the orm
+CACHE = {
+    "Student": TTLCache(maxsize=256, ttl=60),
+    "Subject": TTLCache(maxsize=256, ttl=60),
+    "Score": TTLCache(maxsize=256, ttl=60),
+}
+# bumped on every clear, a read only stores its result if no write to the
+# model committed while it was running
+GENERATION = {"Student": 0, "Subject": 0, "Score": 0}
+MISSING = object()
+
+
+def cached(model):
+    def decorator(endpoint):
+        @wraps(endpoint)
+        async def wrapper(**kwargs):
+            cache = CACHE[model]
+            key = (endpoint.__name__, *((k, v) for k, v in kwargs.items() if k != "db"))
+            value = cache.get(key, MISSING)
+            if value is MISSING:
+                generation = GENERATION[model]
+                value = jsonable_encoder(await endpoint(**kwargs))
+                if GENERATION[model] == generation:
+                    cache[key] = value
+            return value
+
+        return wrapper
+
+    return decorator
+
+
+# remembering what a session wrote and clearing the caches once it commits,
+# reads that were in flight across the commit see the new generation and
+# don't cache their old rows
+def mark_written(session, model):
+    session.info.setdefault("written", set()).add(model)
+
+
+def model_written(mapper, connection, target):
+    mark_written(object_session(target), type(target).__name__)
+
+
+for model in (Student, Subject, Score):
+    for name in ("after_insert", "after_update", "after_delete"):
+        event.listen(model, name, model_written)
+
+
+# bulk insert/update/delete statements skip the mapper events above
+@event.listens_for(Session, "do_orm_execute")
+def statement_written(orm_execute_state):
+    state = orm_execute_state
+    # plain tables (student_subject) aren't part of any cached list
+    if state.bind_mapper is None:
+        return
+    if state.is_insert or state.is_update or state.is_delete:
+        mark_written(state.session, state.bind_mapper.class_.__name__)
+
+
+@event.listens_for(Session, "after_commit")
+def clear_caches(session):
+    for model in session.info.pop("written", ()):
+        GENERATION[model] += 1
+        CACHE[model].clear()
+
+
+@event.listens_for(Session, "after_rollback")
+def forget_writes(session):
+    session.info.pop("written", None)
+
 
 # starting fastapi
-app = FastAPI()
+app = FastAPI(lifespan=lifespan)
 
 
-def get_db():
-    db = SessionLocal()
+@app.middleware("http")
+async def remove_session(request: Request, call_next):
+    token = request_scope.set(next(request_ids))
     try:
-        yield db
+        return await call_next(request)
     finally:
-        db.close()
+        await SessionLocal.remove()
+        request_scope.reset(token)
+
+
+async def get_db():
+    return SessionLocal
 
 
 # making endpoints for updating, geting and deleting data
 
 
 # create sdudent
-@app.post("/students/")
-def create_student(name: str, surname: str, db: Session = Depends(get_db)):
+@app.post("/students/", response_model=StudentOut)
+async def create_student(name: str, surname: str, db: AsyncSession = Depends(get_db)):
     student = Student(name=name, surname=surname)
     db.add(student)
-    db.commit()
-    db.refresh(student)
+    await db.commit()
+    await db.refresh(student)
     return student
 
 
 # getting all student
-@app.get("/students/")
-def get_students(db: Session = Depends(get_db)):
-    return db.query(Student).all()
+@app.get("/students/", response_model=list[StudentOut])
+@cached("Student")
+async def get_students(db: AsyncSession = Depends(get_db)):
+    res = await db.execute(select(Student.id, Student.name, Student.surname))
+    return res.mappings().all()
+
+
+# searching students by name or surname, every word matches as a prefix
+@app.get("/students/search", response_model=list[StudentOut])
+@cached("Student")
+async def search_students(q: str, db: AsyncSession = Depends(get_db)):
+    # quoting the words keeps fts5 syntax in user input literal
+    words = ['"{}"*'.format(word.replace('"', '""')) for word in q.split()]
+    if not words:
+        return []
+    # matching inside a cte so sqlite keeps using the fts index and only
+    # joins the hits back to students
+    hits = (
+        text("SELECT rowid, rank FROM students_fts WHERE students_fts MATCH :match")
+        .bindparams(match=" ".join(words))
+        .columns(rowid=Integer, rank=Float)
+        .cte("hits")
+    )
+    res = await db.execute(
+        select(Student.id, Student.name, Student.surname)
+        .join(hits, Student.id == hits.c.rowid)
+        .order_by(hits.c.rank)
+    )
+    return res.mappings().all()
 
 
 # getting specific student using id
-@app.get("/students/{student_id}")
-def get_student(student_id: int, db: Session = Depends(get_db)):
-    student = db.query(Student).filter(Student.id == student_id).first()
+@app.get("/students/{student_id}", response_model=StudentDetail)
+async def get_student(student_id: int, db: AsyncSession = Depends(get_db)):
+    res = await db.execute(STUDENT_BY_ID, {"pk": student_id})
+    student = res.scalar_one_or_none()
     if not student:
         raise HTTPException(status_code=404, detail="Student not found")
     return student
 
 
+# average, lowest and highest score of a student, computed by sqlite
+@app.get("/students/{student_id}/avg", response_model=StudentAverage)
+async def get_student_average(student_id: int, db: AsyncSession = Depends(get_db)):
+    res = await db.execute(
+        select(
+            Student.id.label("student_id"),
+            func.avg(Score.score).label("average"),
+            func.min(Score.score).label("lowest"),
+            func.max(Score.score).label("highest"),
+        )
+        .outerjoin(Score, Score.student_id == Student.id)
+        .where(Student.id == student_id)
+        .group_by(Student.id)
+    )
+    row = res.mappings().one_or_none()
+    if not row:
+        raise HTTPException(status_code=404, detail="Student not found")
+    return row
+
+
 # updating specific student using student id
-@app.put("/students/{student_id}")
-def update_student(
+@app.put("/students/{student_id}", response_model=StudentOut)
+async def update_student(
     student_id: int,
     name: str = None,
     surname: str = None,
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_db),
 ):
-    student = db.query(Student).filter(Student.id == student_id).first()
+    values = {k: v for k, v in (("name", name), ("surname", surname)) if v}
+    if values:
+        # single UPDATE ... RETURNING instead of select, update and refresh
+        res = await db.execute(
+            update(Student)
+            .where(Student.id == student_id)
+            .values(**values)
+            .returning(Student)
+        )
+        student = res.scalar_one_or_none()
+    else:
+        student = await db.get(Student, student_id)
     if not student:
         raise HTTPException(status_code=404, detail="Student not found")
-    if name:
-        student.name = name
-    if surname:
-        student.surname = surname
-    db.commit()
-    db.refresh(student)
+    await db.commit()
     return student
 
 
 # delete student with student id
 @app.delete("/students/{student_id}")
-def delete_student(student_id: int, db: Session = Depends(get_db)):
-    student = db.query(Student).filter(Student.id == student_id).first()
-    if not student:
+async def delete_student(student_id: int, db: AsyncSession = Depends(get_db)):
+    # clearing what db.delete() used to clean up through the relationships
+    await db.execute(
+        delete(student_subject).where(student_subject.c.student_id == student_id)
+    )
+    await db.execute(
+        update(Score).where(Score.student_id == student_id).values(student_id=None)
+    )
+    res = await db.execute(
+        delete(Student).where(Student.id == student_id).returning(Student.id)
+    )
+    if res.scalar_one_or_none() is None:
         raise HTTPException(status_code=404, detail="Student not found")
-    db.delete(student)
-    db.commit()
+    await db.commit()
     return {"message": "Student deleted"}
 
 
 # create subject
-@app.post("/subjects/")
-def create_subject(name: str, db: Session = Depends(get_db)):
+@app.post("/subjects/", response_model=SubjectOut)
+async def create_subject(name: str, db: AsyncSession = Depends(get_db)):
     subject = Subject(name=name)
     db.add(subject)
-    db.commit()
-    db.refresh(subject)
+    await db.commit()
+    await db.refresh(subject)
     return subject
 
 
 # getting all subjects
-@app.get("/subjects/")
-def get_subjects(db: Session = Depends(get_db)):
-    return db.query(Subject).all()
+@app.get("/subjects/", response_model=list[SubjectOut])
+@cached("Subject")
+async def get_subjects(db: AsyncSession = Depends(get_db)):
+    res = await db.execute(select(Subject.id, Subject.name))
+    return res.mappings().all()
+
+
+# subjects with the best average score
+@app.get("/subjects/top", response_model=list[SubjectAverage])
+async def get_top_subjects(
+    limit: int = Query(5, ge=1, le=100), db: AsyncSession = Depends(get_db)
+):
+    res = await db.execute(
+        select(Subject.id, Subject.name, func.avg(Score.score).label("average"))
+        .join(Score, Score.subject_id == Subject.id)
+        .group_by(Subject.id)
+        .order_by(desc("average"))
+        .limit(limit)
+    )
+    return res.mappings().all()
 
 
 # deleting subject using subject id
 @app.delete("/subjects/{subject_id}")
-def delete_subject(subject_id: int, db: Session = Depends(get_db)):
-    subject = db.query(Subject).filter(Subject.id == subject_id).first()
-    if not subject:
+async def delete_subject(subject_id: int, db: AsyncSession = Depends(get_db)):
+    # clearing what db.delete() used to clean up through the relationships
+    await db.execute(
+        delete(student_subject).where(student_subject.c.subject_id == subject_id)
+    )
+    await db.execute(
+        update(Score).where(Score.subject_id == subject_id).values(subject_id=None)
+    )
+    res = await db.execute(
+        delete(Subject).where(Subject.id == subject_id).returning(Subject.id)
+    )
+    if res.scalar_one_or_none() is None:
         raise HTTPException(status_code=404, detail="Subject not found")
-    db.delete(subject)
-    db.commit()
+    await db.commit()
     return {"message": "Subject deleted"}
 
 
 # create score table
-@app.post("/scores/")
-def add_score(
-    student_id: int, subject_id: int, score: int, db: Session = Depends(get_db)
+@app.post("/scores/", response_model=ScoreOut)
+async def add_score(
+    student_id: int, subject_id: int, score: int, db: AsyncSession = Depends(get_db)
 ):
     new_score = Score(student_id=student_id, subject_id=subject_id, score=score)
     db.add(new_score)
-    db.commit()
-    db.refresh(new_score)
+    await db.commit()
+    await db.refresh(new_score)
     return new_score
 
 
+# adding many scores in one INSERT and one commit
+@app.post("/scores/bulk", response_model=list[ScoreOut])
+async def add_scores(items: list[ScoreIn], db: AsyncSession = Depends(get_db)):
+    if not items:
+        return []
+    res = await db.execute(
+        insert(Score).returning(Score, sort_by_parameter_order=True),
+        [item.model_dump() for item in items],
+    )
+    new_scores = res.scalars().all()
+    await db.commit()
+    return new_scores
+
+
 # gett all the scores with subject id and student id
-@app.get("/scores/")
-def get_scores(db: Session = Depends(get_db)):
-    return db.query(Score).all()
+@app.get("/scores/", response_model=list[ScoreOut])
+@cached("Score")
+async def get_scores(db: AsyncSession = Depends(get_db)):
+    res = await db.execute(
+        select(Score.id, Score.student_id, Score.subject_id, Score.score)
+    )
+    return res.mappings().all()
 
 
 # get score with score_id
-@app.get("/scores/{score_id}")
-def get_score(score_id: int, db: Session = Depends(get_db)):
-    score = db.query(Score).filter(Score.id == score_id).first()
+@app.get("/scores/{score_id}", response_model=ScoreDetail)
+async def get_score(score_id: int, db: AsyncSession = Depends(get_db)):
+    res = await db.execute(SCORE_BY_ID, {"pk": score_id})
+    score = res.scalar_one_or_none()
     if not score:
         raise HTTPException(status_code=404, detail="Score not found")
     return score
@@ -184,10 +587,11 @@ def get_score(score_id: int, db: Session = Depends(get_db)):
 
 # getting specific score data with score id
 @app.delete("/scores/{score_id}")
-def delete_score(score_id: int, db: Session = Depends(get_db)):
-    score = db.query(Score).filter(Score.id == score_id).first()
-    if not score:
+async def delete_score(score_id: int, db: AsyncSession = Depends(get_db)):
+    res = await db.execute(
+        delete(Score).where(Score.id == score_id).returning(Score.id)
+    )
+    if res.scalar_one_or_none() is None:
         raise HTTPException(status_code=404, detail="Score not found")
-    db.delete(score)
-    db.commit()
+    await db.commit()
     return {"message": "Score deleted"}